@@ -23,9 +23,9 @@ Usage:
 """
 
 import argparse
+import collections
 import json
 import os
-import shutil
 import subprocess
 import sys
 
@@ -92,22 +92,31 @@ def merge_lora(base_model_name: str, lora_path: str, output_dir: str):
     print("Step 1: Merging LoRA weights")
     print("=" * 60)
 
+    # Merge on CPU in bf16: no GPU needed and no device round-trip before saving
     print(f"Loading base model: {base_model_name}")
     base_model = AutoModelForCausalLM.from_pretrained(
         base_model_name,
-        torch_dtype=torch.float16,
-        device_map="auto",
+        torch_dtype=torch.bfloat16,
+        device_map={"": "cpu"},
+        low_cpu_mem_usage=True,
         trust_remote_code=True,
     )
 
     print(f"Loading LoRA weights from: {lora_path}")
-    model = PeftModel.from_pretrained(base_model, lora_path)
+    # safetensors adapters are memory-mapped on load. is_trainable=False is the
+    # default; it is passed explicitly since the merge only needs inference mode.
+    model = PeftModel.from_pretrained(base_model, lora_path, is_trainable=False)
 
     print("Merging weights...")
     merged_model = model.merge_and_unload()
 
     print(f"Saving merged model to: {output_dir}")
-    merged_model.save_pretrained(output_dir, safe_serialization=True)
+    # bf16 in small shards lets the GGUF converter stream one shard at a time
+    merged_model.to(dtype=torch.bfloat16).save_pretrained(
+        output_dir,
+        safe_serialization=True,
+        max_shard_size="1GB",
+    )
 
     # Also save tokenizer
     tokenizer = AutoTokenizer.from_pretrained(lora_path)
@@ -117,6 +126,25 @@ def merge_lora(base_model_name: str, lora_path: str, output_dir: str):
     return output_dir
 
 
+def run_command(cmd, tail_lines: int = 20):
+    """Run a command, streaming its output live.
+
+    Returns the exit code and the last few output lines for error reporting.
+    """
+    tail = collections.deque(maxlen=tail_lines)
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+    )
+    for line in proc.stdout:
+        sys.stdout.write(line)
+        tail.append(line)
+    return proc.wait(), "".join(tail)
+
+
 def convert_to_gguf(
     model_path: str,
     output_path: str,
@@ -137,29 +165,40 @@ def convert_to_gguf(
         print("  cd llama.cpp && make")
         sys.exit(1)
 
-    # First convert to f16 GGUF
-    f16_output = output_path.replace(".gguf", "-f16.gguf")
-    print(f"Converting to GGUF (f16): {f16_output}")
+    # Types the converter can emit directly, without a llama-quantize pass
+    direct_outtypes = {"f16", "q8_0"}
+
+    if quantize in direct_outtypes:
+        convert_output = output_path
+        outtype = quantize
+    else:
+        # K-quants need llama-quantize to compute per-block scales, and it seeks
+        # in its input file, so an intermediate file is still required. bf16
+        # matches the merged weights, so the conversion writes them unchanged.
+        convert_output = output_path.replace(".gguf", "-bf16.gguf")
+        outtype = "bf16"
+
+    print(f"Converting to GGUF ({outtype}): {convert_output}")
 
     cmd = [
         sys.executable,
         convert_script,
         model_path,
         "--outfile",
-        f16_output,
+        convert_output,
         "--outtype",
-        "f16",
+        outtype,
     ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"Error converting to GGUF: {result.stderr}")
+    returncode, output_tail = run_command(cmd)
+    if returncode != 0:
+        print(f"Error converting to GGUF:\n{output_tail}")
         sys.exit(1)
 
-    print("Conversion to f16 GGUF complete!")
+    print(f"Conversion to {outtype} GGUF complete!")
 
     # Quantize if needed
-    if quantize != "f16":
+    if quantize not in direct_outtypes:
         print(f"\nQuantizing to {quantize}...")
         quantize_bin = os.path.join(llama_cpp_path, "llama-quantize")
 
@@ -168,27 +207,32 @@ def convert_to_gguf(
             print("Please build llama.cpp: cd llama.cpp && make")
             sys.exit(1)
 
-        cmd = [quantize_bin, f16_output, output_path, quantize]
-
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"Error quantizing: {result.stderr}")
+        # Trailing positional argument is the thread count
+        cmd = [
+            quantize_bin,
+            convert_output,
+            output_path,
+            quantize,
+            str(os.cpu_count() or 1),
+        ]
+
+        returncode, output_tail = run_command(cmd)
+        if returncode != 0:
+            print(f"Error quantizing:\n{output_tail}")
             sys.exit(1)
 
-        # Remove f16 intermediate file
-        os.remove(f16_output)
+        # Remove bf16 intermediate file
+        os.remove(convert_output)
         print(f"Quantization complete: {output_path}")
-    else:
-        shutil.move(f16_output, output_path)
 
     # Print file size
-    size_mb = os.path.getsize(output_path) / (1024 * 1024)
-    print(f"Final model size: {size_mb:.1f} MB")
+    size_bytes = os.path.getsize(output_path)
+    print(f"Final model size: {size_bytes / (1024 * 1024):.1f} MB")
 
-    return output_path
+    return output_path, size_bytes
 
 
-def create_model_info(output_path: str, args):
+def create_model_info(output_path: str, size_bytes: int, args):
     """Create model info JSON file."""
     info = {
         "name": "Elio-Qwen3-1.7B-JP",
@@ -196,7 +240,7 @@ def create_model_info(output_path: str, args):
         "base_model": args.base_model,
         "quantization": args.quantize,
         "file": os.path.basename(output_path),
-        "size_mb": os.path.getsize(output_path) / (1024 * 1024),
+        "size_mb": size_bytes / (1024 * 1024),
         "features": [
             "Japanese thinking (<think> tags)",
             "Optimized for mobile deployment",
@@ -210,7 +254,7 @@ def create_model_info(output_path: str, args):
     }
 
     info_path = output_path.replace(".gguf", "-info.json")
-    with open(info_path, "w", encoding="utf-8") as f:
+    with open(info_path, "w", encoding="utf-8", buffering=1 << 16) as f:
         json.dump(info, f, indent=2, ensure_ascii=False)
 
     print(f"Model info saved to: {info_path}")
@@ -236,13 +280,13 @@ def main():
 
     # Step 2: Convert to GGUF
     if not args.skip_convert:
-        convert_to_gguf(
+        gguf_path, size_bytes = convert_to_gguf(
             args.output_dir,
             args.gguf_output,
             args.llama_cpp_path,
             args.quantize,
         )
-        create_model_info(args.gguf_output, args)
+        create_model_info(gguf_path, size_bytes, args)
     else:
         print("Skipping GGUF conversion step")
 
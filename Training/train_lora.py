@@ -8,6 +8,9 @@ This script fine-tunes Qwen3 1.7B using LoRA to output thinking in Japanese.
 Requirements:
     pip install torch transformers peft datasets accelerate bitsandbytes
 
+    # Optional (CUDA): FlashAttention-2, falls back to SDPA when absent
+    pip install flash-attn --no-build-isolation
+
 Usage:
     python train_lora.py --output_dir ./elio-qwen3-1.7b-jp
 
@@ -19,12 +22,13 @@ For CPU training (slow):
 """
 
 import argparse
+import importlib.util
 import json
 import os
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import torch
-from datasets import Dataset
+from datasets import Dataset, load_dataset
 from peft import (
     LoraConfig,
     TaskType,
@@ -41,6 +45,15 @@ from transformers import (
 )
 
 
+# Opening of the app's Japanese system prompt (SystemPromptLocalizations.swift).
+# Without an explicit system turn, Qwen chat templates inject their own default
+# ("You are Qwen, created by Alibaba Cloud..."), which the app never sends.
+DEFAULT_SYSTEM_PROMPT = (
+    "あなたは「ElioChat」（エリオチャット）です。"
+    "ユーザーのデバイス上で動作するプライベートなAIアシスタントです。"
+)
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Train Qwen3 1.7B with LoRA for Japanese thinking")
     parser.add_argument(
@@ -53,7 +66,7 @@ def parse_args():
         "--training_data",
         type=str,
         default="training_data.json",
-        help="Path to training data JSON file",
+        help="Path to training data JSON or JSONL file",
     )
     parser.add_argument(
         "--output_dir",
@@ -98,9 +111,10 @@ def parse_args():
     )
     parser.add_argument(
         "--use_4bit",
-        action="store_true",
+        action=argparse.BooleanOptionalAction,
         default=True,
-        help="Use 4-bit quantization for training",
+        help="Use 4-bit quantization for training (CUDA only; --no-use_4bit "
+        "trains in bf16 and enables torch.compile)",
     )
     parser.add_argument(
         "--max_length",
@@ -108,69 +122,118 @@ def parse_args():
         default=2048,
         help="Maximum sequence length",
     )
+    parser.add_argument(
+        "--system_prompt",
+        type=str,
+        default=DEFAULT_SYSTEM_PROMPT,
+        help="System prompt prepended to conversations that have none",
+    )
     return parser.parse_args()
 
 
-def load_training_data(file_path: str) -> List[Dict]:
-    """Load training data from JSON file."""
-    with open(file_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return data
-
+def format_conversation(
+    conversation: Dict, tokenizer, system_prompt: str = ""
+) -> Tuple[str, Optional[List[Tuple[int, int]]]]:
+    """Format a conversation into the model's chat template.
 
-def format_conversation(conversation: Dict, tokenizer) -> str:
-    """Format a conversation into the model's chat template."""
+    Returns the formatted text and the character spans of the assistant
+    replies (content and end-of-turn token, without the role header), or
+    None for the spans if they cannot be located reliably.
+    """
     messages = conversation["conversations"]
+    if system_prompt and (not messages or messages[0]["role"] != "system"):
+        messages = [{"role": "system", "content": system_prompt}] + messages
+
+    def render(msgs, add_generation_prompt=False):
+        return tokenizer.apply_chat_template(
+            msgs,
+            tokenize=False,
+            add_generation_prompt=add_generation_prompt,
+        )
 
-    # Build chat format
-    formatted = ""
-    for msg in messages:
-        role = msg["role"]
-        content = msg["content"]
-
-        if role == "user":
-            formatted += f"<|im_start|>user\n{content}<|im_end|>\n"
-        elif role == "assistant":
-            formatted += f"<|im_start|>assistant\n{content}<|im_end|>\n"
-        elif role == "system":
-            formatted += f"<|im_start|>system\n{content}<|im_end|>\n"
-
-    return formatted
-
-
-def prepare_dataset(training_data: List[Dict], tokenizer, max_length: int) -> Dataset:
+    text = render(messages)
+
+    # Spans come from the rendered lengths of conversation prefixes. That only
+    # holds while each prefix renders as a prefix of the full text; templates
+    # such as Qwen3's rewrite earlier assistant turns (dropping <think>), so
+    # check it for every turn instead of assuming it.
+    assistant_spans = []
+    for i, msg in enumerate(messages):
+        if msg["role"] == "assistant":
+            # A leading assistant turn has no prompt to anchor its start on
+            if i == 0:
+                return text, None
+            prompt = render(messages[:i], add_generation_prompt=True)
+            turn = render(messages[: i + 1])
+            if not (turn.startswith(prompt) and text.startswith(turn)):
+                return text, None
+            # End at the end-of-turn token, excluding the template's trailing newline
+            assistant_spans.append((len(prompt), len(turn.rstrip("\n"))))
+
+    return text, assistant_spans
+
+
+def prepare_dataset(
+    dataset: Dataset, tokenizer, max_length: int, system_prompt: str = ""
+) -> Dataset:
     """Prepare the dataset for training."""
 
     def tokenize_function(examples):
         texts = []
+        spans = []
         for conv in examples["conversations"]:
-            text = format_conversation({"conversations": conv}, tokenizer)
+            text, assistant_spans = format_conversation(
+                {"conversations": conv}, tokenizer, system_prompt
+            )
+            # Drop examples whose assistant turns cannot be located
+            if assistant_spans is None:
+                continue
             texts.append(text)
+            spans.append(assistant_spans)
 
         tokenized = tokenizer(
             texts,
             truncation=True,
             max_length=max_length,
-            padding="max_length",
-            return_tensors="pt",
+            padding=False,
+            return_offsets_mapping=True,
         )
 
-        # Labels are the same as input_ids for causal LM
-        tokenized["labels"] = tokenized["input_ids"].clone()
+        # Labels are the same as input_ids for causal LM, but only assistant
+        # tokens are trained on: system/user tokens are masked to -100 so the
+        # loss ignores them. Batch padding added by the collator is masked via
+        # label_pad_token_id.
+        labels = []
+        for ids, offsets, assistant_spans in zip(
+            tokenized["input_ids"], tokenized.pop("offset_mapping"), spans
+        ):
+            labels.append([
+                tok
+                if any(start <= tok_start < end for start, end in assistant_spans)
+                else -100
+                for tok, (tok_start, _) in zip(ids, offsets)
+            ])
+        tokenized["labels"] = labels
+
+        # Used by group_by_length to batch similar-length examples together
+        tokenized["length"] = [len(ids) for ids in tokenized["input_ids"]]
 
         return tokenized
 
-    # Create dataset
-    dataset_dict = {"conversations": [d["conversations"] for d in training_data]}
-    dataset = Dataset.from_dict(dataset_dict)
-
     # Tokenize
     tokenized_dataset = dataset.map(
         tokenize_function,
         batched=True,
-        remove_columns=["conversations"],
+        batch_size=1000,
+        num_proc=max(1, (os.cpu_count() or 1) // 2),
+        load_from_cache_file=True,
+        remove_columns=dataset.column_names,
     )
 
+    skipped = len(dataset) - len(tokenized_dataset)
+    if skipped:
+        print(f"Skipped {skipped} examples with unlocatable assistant turns")
+
     return tokenized_dataset
 
 
@@ -200,6 +263,12 @@ def main():
         device = "cpu"
         print("No GPU available, using CPU")
 
+    # TF32 matmuls on Ampere and newer GPUs
+    use_tf32 = device == "cuda" and torch.cuda.get_device_capability()[0] >= 8
+    if use_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+
     # Load tokenizer
     print("\nLoading tokenizer...")
     tokenizer = AutoTokenizer.from_pretrained(
@@ -219,21 +288,33 @@ def main():
             bnb_4bit_quant_type="nf4",
             bnb_4bit_compute_dtype=torch.bfloat16,
             bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_storage=torch.bfloat16,
         )
 
+    # Attention kernel: FlashAttention-2 when installed on CUDA, otherwise SDPA
+    if device == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+        attn_implementation = "flash_attention_2"
+    else:
+        attn_implementation = "sdpa"
+
     # Load model
-    print("Loading model...")
+    print(f"Loading model (attention: {attn_implementation})...")
     model = AutoModelForCausalLM.from_pretrained(
         args.model_name,
         quantization_config=bnb_config,
         device_map="auto" if device != "cpu" else None,
         trust_remote_code=True,
         torch_dtype=torch.bfloat16 if device != "cpu" else torch.float32,
+        attn_implementation=attn_implementation,
+        low_cpu_mem_usage=True,
     )
 
     if device == "cpu":
         model = model.to(device)
 
+    # KV cache is unused during training and conflicts with gradient checkpointing
+    model.config.use_cache = False
+
     # Prepare model for training
     if bnb_config:
         model = prepare_model_for_kbit_training(model)
@@ -258,18 +339,31 @@ def main():
     )
 
     model = get_peft_model(model, lora_config)
+
+    # get_peft_model creates the LoRA weights in fp32 (newer PEFT also upcasts
+    # them via autocast_adapter_dtype); keep them in the bf16 compute dtype to
+    # avoid upcasts on every forward
+    if bnb_config:
+        for name, param in model.named_parameters():
+            if param.requires_grad and "lora_" in name:
+                param.data = param.data.to(torch.bfloat16)
+        model.config.torch_dtype = torch.bfloat16
+
     model.print_trainable_parameters()
 
     # Load and prepare training data
     print("\nLoading training data...")
     script_dir = os.path.dirname(os.path.abspath(__file__))
     training_data_path = os.path.join(script_dir, args.training_data)
-    training_data = load_training_data(training_data_path)
+    # Loads JSON or JSONL straight into a memory-mapped Arrow table
+    training_data = load_dataset("json", data_files=training_data_path, split="train")
     print(f"Loaded {len(training_data)} training examples")
 
     # Prepare dataset
     print("Preparing dataset...")
-    dataset = prepare_dataset(training_data, tokenizer, args.max_length)
+    dataset = prepare_dataset(
+        training_data, tokenizer, args.max_length, args.system_prompt
+    )
 
     # Training arguments
     training_args = TrainingArguments(
@@ -281,20 +375,39 @@ def main():
         weight_decay=0.01,
         warmup_ratio=0.1,
         logging_steps=10,
-        save_strategy="epoch",
-        save_total_limit=2,
+        save_strategy="steps",
+        save_steps=500,
+        save_total_limit=1,
+        save_safetensors=True,
+        save_only_model=True,
         bf16=device == "cuda",
         fp16=False,
-        optim="adamw_torch",
+        # 8-bit paged optimizer state and QLoRA gradient clipping for 4-bit training
+        optim="paged_adamw_8bit" if bnb_config else "adamw_torch",
+        max_grad_norm=0.3 if bnb_config else 1.0,
         report_to="none",
         gradient_checkpointing=True,
-        dataloader_num_workers=0,
+        tf32=use_tf32,
+        # Trainer compiles and unwraps the model itself. Only with --no-use_4bit
+        # on CUDA: unreliable on MPS, and Trainer refuses to compile 4-bit models.
+        # "default" mode rather than "reduce-overhead", since CUDA graphs fit
+        # badly with varying sequence lengths and gradient checkpointing;
+        # Trainer does not expose dynamic=True, and dynamic shapes are detected
+        # automatically after the first recompile.
+        torch_compile=device == "cuda" and bnb_config is None,
+        torch_compile_mode="default",
+        dataloader_num_workers=max(2, (os.cpu_count() or 1) // 2),
+        dataloader_pin_memory=device == "cuda",
+        group_by_length=True,
+        length_column_name="length",
     )
 
-    # Data collator
+    # Data collator (pads each batch to its longest sequence)
     data_collator = DataCollatorForSeq2Seq(
         tokenizer=tokenizer,
-        padding=True,
+        padding="longest",
+        pad_to_multiple_of=8,
+        label_pad_token_id=-100,
         return_tensors="pt",
     )
 
@@ -315,7 +428,7 @@ def main():
 
     # Save the LoRA weights
     print("\nSaving LoRA weights...")
-    model.save_pretrained(args.output_dir)
+    model.save_pretrained(args.output_dir, safe_serialization=True)
     tokenizer.save_pretrained(args.output_dir)
 
     print("\n" + "=" * 60)
@@ -329,7 +442,7 @@ def main():
         "lora_r": args.lora_r,
         "lora_alpha": args.lora_alpha,
         "epochs": args.epochs,
-        "training_examples": len(training_data),
+        "training_examples": len(dataset),
         "description": "Japanese thinking LoRA for Elio AI Assistant",
     }
 
@@ -5,10 +5,11 @@ Each translation maintains proper iOS .strings format
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-# Base directory
-BASE_DIR = Path("/Users/yuki/workspace/ai/elio/LocalAIAgent/Resources")
+# Base directory (relative to the repository root)
+BASE_DIR = Path(__file__).resolve().parent.parent / "LocalAIAgent" / "Resources"
 
 # Languages to create (excluding already existing en, ja, zh-Hans, zh-Hant, ko, pt-BR, es, fr, de, it, ar, hi)
 # And excluding pt-PT and ru which were just created
@@ -75,27 +76,38 @@ print("This script creates placeholder files.")
 print("Run with Claude to generate actual translations.")
 print()
 
-for lang_code, lang_name in LANGUAGES_TODO:
+
+def make_placeholder(lang_code, lang_name):
+    """Create a placeholder Localizable.strings and return a status line."""
     target_dir = BASE_DIR / f"{lang_code}.lproj"
     target_file = target_dir / "Localizable.strings"
 
     # Skip if exists and non-empty
     if target_file.exists() and target_file.stat().st_size > 100:
-        print(f"✓ {lang_code} ({lang_name}) - already exists")
-        continue
+        return f"✓ {lang_code} ({lang_name}) - already exists"
+
+    content = (
+        f'/*\n  Localizable.strings ({lang_name})\n  Elio\n*/\n\n'
+        f'// MARK: - App General\n'
+        f'"app.name" = "Elio";\n'
+        f'"app.tagline" = "Your secret-keeping second brain.";\n\n'
+        f'// TODO: Complete translation for {lang_name}\n'
+        f'// Run: claude translate en.lproj/Localizable.strings to {lang_code}\n'
+    )
 
     # Create directory
     target_dir.mkdir(exist_ok=True)
 
     # Create placeholder
     with open(target_file, 'w', encoding='utf-8') as f:
-        f.write(f'/*\n  Localizable.strings ({lang_name})\n  Elio\n*/\n\n')
-        f.write(f'// MARK: - App General\n')
-        f.write(f'"app.name" = "Elio";\n')
-        f.write(f'"app.tagline" = "Your secret-keeping second brain.";\n\n')
-        f.write(f'// TODO: Complete translation for {lang_name}\n')
-        f.write(f'// Run: claude translate en.lproj/Localizable.strings to {lang_code}\n')
+        f.write(content)
+
+    return f"Created placeholder: {lang_code} ({lang_name})"
+
 
-    print(f"Created placeholder: {lang_code} ({lang_name})")
+# File I/O bound, so threads are enough
+with ThreadPoolExecutor(max_workers=16) as executor:
+    for status in executor.map(lambda lang: make_placeholder(*lang), LANGUAGES_TODO):
+        print(status)
 
 print("\nDone! Use Claude to complete translations.")